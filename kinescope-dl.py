@@ -35,13 +35,18 @@ class URLType(click.ParamType):
 @click.argument('output_file', type=click.Path())
 @click.option("--ffmpeg-path", default='./ffmpeg', required=False, help='Path to ffmpeg executable', type=click.Path())
 @click.option("--mp4decrypt-path", default='./mp4decrypt', required=False, help='Path to mp4decrypt executable', type=click.Path())
+@click.option(
+    '--concurrency', '-c',
+    default=8, required=False, help='Number of segments to download in parallel', type=click.IntRange(min=1)
+)
 def main(referer,
          best_quality,
          temp, 
          input_url,
          output_file,
          ffmpeg_path,
-         mp4decrypt_path):
+         mp4decrypt_path,
+         concurrency):
     """
     Kinescope-dl: Video downloader for Kinescope
 
@@ -55,23 +60,25 @@ def main(referer,
         referer_url=referer
     )
 
-    downloader: KinescopeDownloader = KinescopeDownloader(kinescope_video, temp, ffmpeg_path=ffmpeg_path, mp4decrypt_path=mp4decrypt_path)
+    with KinescopeDownloader(kinescope_video, temp,
+                             ffmpeg_path=ffmpeg_path,
+                             mp4decrypt_path=mp4decrypt_path,
+                             concurrency=concurrency) as downloader:
+        print('= OPTIONS ============================')
+        video_resolutions = downloader.get_resolutions()
+        chosen_resolution = video_resolutions[-1] if best_quality else video_resolutions[int(input(
+            '   '.join([f'{i + 1}) {r[1]}p' for i, r in enumerate(video_resolutions)]) +
+            '\n> Quality: '
+        )) - 1]
+        print(f'[*] {chosen_resolution[1]}p is selected')
+        print('======================================')
 
-    print('= OPTIONS ============================')
-    video_resolutions = downloader.get_resolutions()
-    chosen_resolution = video_resolutions[-1] if best_quality else video_resolutions[int(input(
-        '   '.join([f'{i + 1}) {r[1]}p' for i, r in enumerate(video_resolutions)]) +
-        '\n> Quality: '
-    )) - 1]
-    print(f'[*] {chosen_resolution[1]}p is selected')
-    print('======================================')
-
-    print('\n= DOWNLOADING =================')
-    downloader.download(
-        output_file if output_file else f'{kinescope_video.video_id}.mp4',
-        chosen_resolution
-    )
-    print('===============================')
+        print('\n= DOWNLOADING =================')
+        downloader.download(
+            output_file if output_file else f'{kinescope_video.video_id}.mp4',
+            chosen_resolution
+        )
+        print('===============================')
 
 
 if __name__ == '__main__':
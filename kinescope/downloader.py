@@ -1,31 +1,95 @@
+import re
 import sys
-from io import BytesIO
+from math import ceil
+from functools import cached_property
+from threading import Event
 from os import PathLike
-from typing import Union
+from typing import IO, Optional, Union
 from pathlib import Path
+from itertools import islice
+from collections import OrderedDict, deque
+from urllib.parse import urljoin
 from requests import Session
-from subprocess import Popen
-from shutil import copyfileobj, rmtree
-from base64 import b64decode, b64encode
-from requests.exceptions import ChunkedEncodingError
+from subprocess import DEVNULL, PIPE, CalledProcessError, Popen, run
+from shutil import rmtree
+from tempfile import TemporaryFile
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from requests.adapters import HTTPAdapter
+from xml.etree.ElementTree import Element, ParseError, fromstring
+from concurrent.futures import ThreadPoolExecutor
+from requests.exceptions import ChunkedEncodingError, ConnectionError as RequestsConnectionError, HTTPError, Timeout
 
 from tqdm import tqdm
-from mpegdash.parser import MPEGDASHParser, MPEGDASH
 
 from kinescope.kinescope import KinescopeVideo
 from kinescope.const import KINESCOPE_BASE_URL
 from kinescope.exceptions import *
 
 
+MPD_NAMESPACES = {'mpd': 'urn:mpeg:dash:schema:mpd:2011', 'cenc': 'urn:mpeg:cenc:2013'}
+CENC_DEFAULT_KID_ATTRIBUTE = f'{{{MPD_NAMESPACES["cenc"]}}}default_KID'
+
+# xs:duration, e.g. PT3M30S or P0Y0M0DT0H3M30.000S
+ISO8601_DURATION_PATTERN = re.compile(
+    r'(?P<sign>-)?P(?:(?P<years>\d+)Y)?(?:(?P<months>\d+)M)?(?:(?P<days>\d+)D)?'
+    r'(?:T(?:(?P<hours>\d+)H)?(?:(?P<minutes>\d+)M)?(?:(?P<seconds>\d+(?:\.\d*)?|\.\d+)S)?)?'
+)
+SEGMENT_TEMPLATE_IDENTIFIER_PATTERN = re.compile(r'\$(RepresentationID|Number|Bandwidth|Time)(%0\d+d)?\$')
+
+CONTENT_RANGE_PATTERN = re.compile(r'bytes (?:(?P<start>\d+)-\d+|\*)/(?P<total>\d+|\*)')
+
+SEGMENT_ATTEMPTS = 5
+SEGMENT_CHUNK_SIZE = 64 * 1024
+SEGMENT_TIMEOUT = (10, 30)
+RETRY_STATUS_CODES = (502, 503, 504)
+MPD_CACHE_SIZE = 16
+
+
+def parse_iso8601_duration(duration: str) -> float:
+    match = ISO8601_DURATION_PATTERN.fullmatch(duration.strip())
+    if not match or duration.strip().endswith(('P', 'T')):
+        raise ValueError(f'Invalid ISO 8601 duration: {duration}')
+
+    parts = {k: float(v) for k, v in match.groupdict().items() if v and k != 'sign'}
+    # Years and months have no fixed length, use the usual 365 and 30 day approximations
+    seconds = ((parts.get('years', 0) * 365 + parts.get('months', 0) * 30 + parts.get('days', 0)) * 86400 +
+               parts.get('hours', 0) * 3600 + parts.get('minutes', 0) * 60 + parts.get('seconds', 0))
+    return -seconds if match.group('sign') else seconds
+
+
+def get_int_attribute(element: Element, name: str) -> Optional[int]:
+    value = element.get(name)
+    return int(value) if value else None
+
+
+def resolve_base_url(base_url: str, element: Element) -> str:
+    element_base_url = element.find('mpd:BaseURL', MPD_NAMESPACES)
+    if element_base_url is None or not (element_base_url.text or '').strip():
+        return base_url
+    return urljoin(base_url, element_base_url.text.strip())
+
+
+def fill_segment_template(template: str, **identifiers) -> str:
+    return SEGMENT_TEMPLATE_IDENTIFIER_PATTERN.sub(
+        lambda m: (m.group(2) or '%s') % identifiers[m.group(1)],
+        template
+    ).replace('$$', '$')
+
+
 class VideoDownloader:
+    # Recently parsed manifests with their ETag, shared between downloaders: mpd_url -> (etag, mpd)
+    _mpd_cache: OrderedDict[str, tuple[str, Element]] = OrderedDict()
+
     def __init__(self, kinescope_video: KinescopeVideo,
                  temp_dir: Union[str, PathLike] = './temp',
                  ffmpeg_path: Union[str, PathLike] = './ffmpeg',
-                 mp4decrypt_path: Union[str, PathLike] = './mp4decrypt'):
+                 mp4decrypt_path: Union[str, PathLike] = './mp4decrypt',
+                 concurrency: int = 8,
+                 mpd_master: Optional[Element] = None):
         self.kinescope_video: KinescopeVideo = kinescope_video
+        self.concurrency: int = concurrency
 
         self.temp_path: Path = Path(temp_dir)
-        self.temp_path.mkdir(parents=True, exist_ok=True)
 
         if getattr(sys, 'frozen', False) and hasattr(sys, '_MEIPASS'):
             meipass_path = Path(sys._MEIPASS).resolve()
@@ -36,143 +100,347 @@ class VideoDownloader:
             self.mp4decrypt_path = mp4decrypt_path
 
         self.http = Session()
+        self.http.headers.update({'Connection': 'keep-alive'})
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=max(32, concurrency))
+        self.http.mount('http://', adapter)
+        self.http.mount('https://', adapter)
 
-        self.mpd_master: MPEGDASH = self._fetch_mpd_master()
+        try:
+            self.mpd_master: Element = mpd_master if mpd_master is not None else self._fetch_mpd_master()
+            self._adaptation_index: dict[str, dict[tuple[int, int], list[str]]] = self._index_mpd_master()
+        except Exception:
+            self.http.close()
+            raise
 
-    def __del__(self):
-        rmtree(self.temp_path)
+        # Created only once the manifest is loaded, so a failed __init__ leaves nothing behind
+        self.temp_path.mkdir(parents=True, exist_ok=True)
+
+    def __enter__(self) -> 'VideoDownloader':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        rmtree(self.temp_path, ignore_errors=True)
+        self.http.close()
 
     def _merge_tracks(self, source_video_filepath: str | PathLike,
                       source_audio_filepath: str | PathLike,
                       target_filepath: str | PathLike):
         try:
-            Popen((self.ffmpeg_path,
-                   "-i", source_video_filepath,
-                   "-i", source_audio_filepath,
-                   "-c", "copy", target_filepath,
-                   "-y", "-loglevel", "error")).communicate()
+            run((self.ffmpeg_path,
+                 "-i", source_video_filepath,
+                 "-i", source_audio_filepath,
+                 "-c", "copy", target_filepath,
+                 "-y", "-loglevel", "error"),
+                stdin=DEVNULL, stdout=DEVNULL, stderr=PIPE, check=True, start_new_session=True)
         except FileNotFoundError:
             raise FFmpegNotFoundError('FFmpeg binary was not found at the specified path')
+        except CalledProcessError as e:
+            raise MergeError(f'FFmpeg failed to merge tracks: {e.stderr.decode(errors="replace").strip()}')
 
     def _decrypt_video(self, source_filepath: str | PathLike,
                        target_filepath: str | PathLike,
-                       key: str):
+                       key: str) -> tuple[Popen, IO[bytes]]:
+        # mp4decrypt runs in the background and nobody reads its stderr until it exits,
+        # so collect it in a file where it can't fill up a pipe and block the process
+        stderr_file = TemporaryFile(dir=self.temp_path)
         try:
-            Popen((self.mp4decrypt_path,
-                   "--key", f"1:{key}",
-                   source_filepath,
-                   target_filepath)).communicate()
+            return Popen((self.mp4decrypt_path,
+                          "--key", f"1:{key}",
+                          source_filepath,
+                          target_filepath),
+                         stdin=DEVNULL, stdout=DEVNULL, stderr=stderr_file, start_new_session=True), stderr_file
         except FileNotFoundError:
-            raise FFmpegNotFoundError('mp4decrypt binary was not found at the specified path')
+            stderr_file.close()
+            raise Mp4DecryptNotFoundError('mp4decrypt binary was not found at the specified path')
+
+    def _get_license_key(self) -> Optional[str]:
+        content_protection = self.mpd_master.find(
+            'mpd:Period/mpd:AdaptationSet/mpd:ContentProtection', MPD_NAMESPACES
+        )
+        if content_protection is None:
+            return None
+
+        # ClearKey uses unpadded base64url for both the key id and the returned key
+        kid = urlsafe_b64encode(
+            bytes.fromhex(content_protection.get(CENC_DEFAULT_KID_ATTRIBUTE).replace('-', ''))
+        ).rstrip(b'=').decode('ascii')
 
-    def _get_license_key(self) -> str:
         try:
-            return b64decode(
-                self.http.post(
-                    url=self.kinescope_video.get_clearkey_license_url(),
-                    headers={'origin': KINESCOPE_BASE_URL},
-                    json={
-                        'kids': [
-                            b64encode(bytes.fromhex(
-                                self.mpd_master
-                                .periods[0]
-                                .adaptation_sets[0]
-                                .content_protections[0]
-                                .cenc_default_kid.replace('-', '')
-                            )).decode().replace('=', '')
-                        ],
-                        'type': 'temporary'
-                    }
-                ).json()['keys'][0]['k'] + '=='
-            ).hex() if self.mpd_master.periods[0].adaptation_sets[0].content_protections else None
+            key = self.http.post(
+                url=self.kinescope_video.get_clearkey_license_url(),
+                headers={'origin': KINESCOPE_BASE_URL},
+                json={'kids': [kid], 'type': 'temporary'}
+            ).json()['keys'][0]['k']
         except KeyError:
             raise UnsupportedEncryption(
                 "Unfortunately, only the ClearKey encryption type is currently supported, "
                 "but not the one in this video"
             )
 
-    def _fetch_segment(self,
-                       segment_url: str,
-                       file):
-        for _ in range(5):
+        return urlsafe_b64decode(key + '=' * (-len(key) % 4)).hex()
+
+    def _fetch_segment(self, segment_url: str, cancelled: Event) -> bytearray:
+        segment = bytearray()
+        received = 0
+        for attempt in range(SEGMENT_ATTEMPTS):
+            if cancelled.is_set():
+                raise SegmentDownloadError(f'Download of segment {segment_url} was cancelled')
+            # MP4 payloads are already compressed, so ask for them as is
+            headers = {'Accept-Encoding': 'identity'}
+            # Resume from the bytes already received instead of downloading the segment again
+            if received:
+                headers['Range'] = f'bytes={received}-'
             try:
-                copyfileobj(
-                    BytesIO(self.http.get(segment_url, stream=True).content),
-                    file
-                )
-                return
-            except ChunkedEncodingError:
+                with self.http.get(segment_url, headers=headers, stream=True, timeout=SEGMENT_TIMEOUT) as r:
+                    content_range = CONTENT_RANGE_PATTERN.fullmatch(r.headers.get('Content-Range', ''))
+                    if received and r.status_code == 416:
+                        # The previous attempt broke off right after the last byte, nothing is missing
+                        if content_range and content_range['total'] == str(received):
+                            break
+                        received = 0
+                    elif r.status_code == 206 and not (content_range and content_range['start'] == str(received)):
+                        # The server answered with another range than requested, start the segment over
+                        received = 0
+                    else:
+                        r.raise_for_status()
+                        if r.status_code == 206:
+                            expected = int(content_range['total']) if content_range['total'] != '*' else None
+                        else:
+                            received = 0
+                            expected = int(r.headers['Content-Length']) if 'Content-Length' in r.headers else None
+                            # Presize the buffer so every chunk is copied into place exactly once
+                            segment = bytearray(expected or 0)
+                        for chunk in r.iter_content(chunk_size=SEGMENT_CHUNK_SIZE):
+                            if cancelled.is_set():
+                                raise SegmentDownloadError(f'Download of segment {segment_url} was cancelled')
+                            segment[received:received + len(chunk)] = chunk
+                            received += len(chunk)
+                        # A body shorter than announced is an interrupted read, resume it on the next attempt
+                        if expected is None or received >= expected:
+                            break
+            except HTTPError as e:
+                if e.response.status_code not in RETRY_STATUS_CODES:
+                    raise SegmentDownloadError(f'Failed to download segment {segment_url}: {e}')
+            except (ChunkedEncodingError, RequestsConnectionError, Timeout):
                 pass
 
-        raise SegmentDownloadError(f'Failed to download segment {segment_url}')
+            if attempt < SEGMENT_ATTEMPTS - 1:
+                cancelled.wait(0.2 * 2 ** attempt)
+        else:
+            raise SegmentDownloadError(f'Failed to download segment {segment_url}')
+
+        del segment[received:]
+        return segment
 
     def _fetch_segments(self,
                         segments_urls: list[str],
                         filepath: str | PathLike,
                         progress_bar_label: str = ''):
-        segments_urls = [seg for i, seg in enumerate(segments_urls) if i == segments_urls.index(seg)]
         with open(filepath, 'wb') as f:
             with tqdm(desc=progress_bar_label,
                       total=len(segments_urls),
                       bar_format='{desc}: {percentage:3.0f}%|{bar:10}| [{n_fmt}/{total_fmt}]') as progress_bar:
-                for segment_url in segments_urls:
-                    self._fetch_segment(segment_url, f)
-                    progress_bar.update()
+                with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+                    # Keep a bounded prefetch window so finished segments don't pile up in memory
+                    pending_urls = iter(segments_urls)
+                    cancelled = Event()
+                    futures = deque(
+                        executor.submit(self._fetch_segment, url, cancelled)
+                        for url in islice(pending_urls, self.concurrency * 2)
+                    )
+                    try:
+                        while futures:
+                            segment = futures.popleft().result()
+                            url = next(pending_urls, None)
+                            if url is not None:
+                                futures.append(executor.submit(self._fetch_segment, url, cancelled))
+                            f.write(segment)
+                            progress_bar.update()
+                    finally:
+                        # Stop running fetches too, so leaving the executor doesn't wait for their retries
+                        cancelled.set()
+                        for future in futures:
+                            future.cancel()
 
     def _get_segments_urls(self, resolution: tuple[int, int]) -> dict[str:list[str]]:
+        segments_urls = {}
+        for mime_type, representations in self._adaptation_index.items():
+            if next(iter(representations))[1]:
+                if resolution not in representations:
+                    raise InvalidResolution('Invalid resolution specified')
+                segments_urls[mime_type] = representations[resolution]
+            else:
+                segments_urls[mime_type] = next(iter(representations.values()))
+        return segments_urls
+
+    def _index_mpd_master(self) -> dict[str, dict[tuple[int, int], list[str]]]:
+        period = self.mpd_master.find('mpd:Period', MPD_NAMESPACES)
+        if period is None:
+            raise InvalidManifest('MPD manifest has no DASH Period')
+
+        period_base_url = resolve_base_url(
+            resolve_base_url(self.kinescope_video.get_mpd_master_playlist_url(), self.mpd_master), period
+        )
+
+        adaptation_index = {}
+        for adaptation_set in period.iterfind('mpd:AdaptationSet', MPD_NAMESPACES):
+            adaptation_set_base_url = resolve_base_url(period_base_url, adaptation_set)
+            representations = adaptation_index.setdefault(adaptation_set.get('mimeType'), {})
+            for representation in adaptation_set.iterfind('mpd:Representation', MPD_NAMESPACES):
+                representations.setdefault((
+                    get_int_attribute(representation, 'width'),
+                    get_int_attribute(representation, 'height')
+                ), list(dict.fromkeys(self._get_representation_segments_urls(
+                    adaptation_set, representation,
+                    resolve_base_url(adaptation_set_base_url, representation)
+                ))))
+        return adaptation_index
+
+    def _get_representation_segments_urls(self, adaptation_set: Element,
+                                          representation: Element,
+                                          base_url: str) -> list[str]:
+        template = representation.find('mpd:SegmentTemplate', MPD_NAMESPACES)
+        if template is None:
+            template = adaptation_set.find('mpd:SegmentTemplate', MPD_NAMESPACES)
+        if template is None:
+            urls = [
+                urljoin(base_url, segment_url.get('media'))
+                for segment_url in representation.iterfind('mpd:SegmentList/mpd:SegmentURL', MPD_NAMESPACES)
+            ]
+            if not urls:
+                raise InvalidManifest(
+                    f'Representation {representation.get("id")} has neither SegmentTemplate nor SegmentList'
+                )
+            return urls
+
+        identifiers = {
+            'RepresentationID': representation.get('id'),
+            'Bandwidth': get_int_attribute(representation, 'bandwidth')
+        }
+        timescale = get_int_attribute(template, 'timescale') or 1
+        start_number = get_int_attribute(template, 'startNumber')
+        start_number = start_number if start_number is not None else 1
+        duration = get_int_attribute(template, 'duration')
+
+        segments = []
+        timeline = template.findall('mpd:SegmentTimeline/mpd:S', MPD_NAMESPACES)
+        if timeline:
+            time = 0
+            for i, s in enumerate(timeline):
+                t, d, r = (get_int_attribute(s, a) for a in ('t', 'd', 'r'))
+                if not d:
+                    raise InvalidManifest('SegmentTimeline S element without a duration')
+                if t is not None:
+                    time = t
+                repeat = r or 0
+                if repeat < 0:
+                    # A negative repeat lasts until the next S element or the end of the period
+                    next_t = get_int_attribute(timeline[i + 1], 't') if i + 1 < len(timeline) else None
+                    end = next_t if next_t is not None else self._presentation_duration * timescale
+                    if end <= time:
+                        raise InvalidManifest('Unable to determine the number of segments: unknown duration')
+                    repeat = ceil((end - time) / d) - 1
+                for _ in range(repeat + 1):
+                    segments.append(time)
+                    time += d
+        elif duration and self._presentation_duration:
+            segments = [i * duration for i in range(ceil(self._presentation_duration * timescale / duration))]
+        else:
+            raise InvalidManifest('Unable to determine the number of segments: unknown duration')
+
+        urls = [urljoin(base_url, fill_segment_template(template.get('initialization'), **identifiers))] \
+            if template.get('initialization') else []
+        urls.extend(
+            urljoin(base_url, fill_segment_template(template.get('media'), Number=start_number + i, Time=time,
+                                                    **identifiers))
+            for i, time in enumerate(segments)
+        )
+        return urls
+
+    @cached_property
+    def _presentation_duration(self) -> float:
+        # Parsed on first use only, manifests that don't need the duration never touch it
+        presentation_duration = (self.mpd_master.find('mpd:Period', MPD_NAMESPACES).get('duration') or
+                                 self.mpd_master.get('mediaPresentationDuration'))
         try:
-            return {
-                adaptation_set.mime_type: [
-                    segment_url.media for segment_url in adaptation_set.representations[
-                        [(r.width, r.height) for r in adaptation_set.representations].index(resolution)
-                        if adaptation_set.representations[0].height else 0
-                    ].segment_lists[0].segment_urls
-                ] for adaptation_set in self.mpd_master.periods[0].adaptation_sets
-            }
-        except ValueError:
-            raise InvalidResolution('Invalid resolution specified')
-
-    def _fetch_mpd_master(self) -> MPEGDASH:
-        return MPEGDASHParser.parse(self.http.get(
-            url=self.kinescope_video.get_mpd_master_playlist_url(),
-            headers={'Referer': KINESCOPE_BASE_URL}
-        ).text)
+            return parse_iso8601_duration(presentation_duration) if presentation_duration else 0
+        except ValueError as e:
+            raise InvalidManifest(str(e))
+
+    def _fetch_mpd_master(self) -> Element:
+        mpd_url = self.kinescope_video.get_mpd_master_playlist_url()
+        headers = {'Referer': KINESCOPE_BASE_URL}
+
+        cached = self._mpd_cache.get(mpd_url)
+        if cached:
+            headers['If-None-Match'] = cached[0]
+
+        r = self.http.get(url=mpd_url, headers=headers)
+        if cached and r.status_code == 304:
+            self._mpd_cache.move_to_end(mpd_url)
+            return cached[1]
+
+        if r.status_code == 404:
+            raise VideoNotFound('Video not found')
+        if not r.ok:
+            raise DownloadError(f'Failed to fetch MPD manifest: HTTP {r.status_code}')
+
+        try:
+            mpd_master = fromstring(r.content)
+        except ParseError as e:
+            raise InvalidManifest(f'Failed to parse MPD manifest: {e}')
+
+        if r.headers.get('ETag'):
+            self._mpd_cache[mpd_url] = (r.headers['ETag'], mpd_master)
+            self._mpd_cache.move_to_end(mpd_url)
+            if len(self._mpd_cache) > MPD_CACHE_SIZE:
+                self._mpd_cache.popitem(last=False)
+
+        return mpd_master
 
     def get_resolutions(self) -> list[tuple[int, int]]:
-        for adaptation_set in self.mpd_master.periods[0].adaptation_sets:
-            if adaptation_set.representations[0].height:
-                return [(r.width, r.height) for r in sorted(adaptation_set.representations, key=lambda r: r.height)]
+        for representations in self._adaptation_index.values():
+            if next(iter(representations))[1]:
+                return sorted(representations, key=lambda r: r[1])
 
     def download(self, filepath: str, resolution: tuple[int, int] = None):
         if not resolution:
             resolution = self.get_resolutions()[-1]
 
         key = self._get_license_key()
+        segments_urls = self._get_segments_urls(resolution)
 
-        self._fetch_segments(
-            self._get_segments_urls(resolution)['video/mp4'],
-            self.temp_path / f'{self.kinescope_video.video_id}_video.mp4{".enc" if key else ""}',
-            'Video'
-        )
-        self._fetch_segments(
-            self._get_segments_urls(resolution)['audio/mp4'],
-            self.temp_path / f'{self.kinescope_video.video_id}_audio.mp4{".enc" if key else ""}',
-            'Audio'
-        )
+        decrypt_processes = []
+        try:
+            for track, label in (('audio', 'Audio'), ('video', 'Video')):
+                track_path = self.temp_path / f'{self.kinescope_video.video_id}_{track}.mp4'
+                encrypted_track_path = track_path.with_name(f'{track_path.name}.enc')
 
-        if key:
-            print('[*] Decrypting...', end=' ')
-            self._decrypt_video(
-                self.temp_path / f'{self.kinescope_video.video_id}_video.mp4.enc',
-                self.temp_path / f'{self.kinescope_video.video_id}_video.mp4',
-                key
-            )
-            self._decrypt_video(
-                self.temp_path / f'{self.kinescope_video.video_id}_audio.mp4.enc',
-                self.temp_path / f'{self.kinescope_video.video_id}_audio.mp4',
-                key
-            )
-            print('Done')
+                self._fetch_segments(
+                    segments_urls[f'{track}/mp4'],
+                    encrypted_track_path if key else track_path,
+                    label
+                )
+
+                # Decryption runs in the background while the next track is downloading
+                if key:
+                    decrypt_processes.append(self._decrypt_video(encrypted_track_path, track_path, key))
+
+            if decrypt_processes:
+                print('[*] Decrypting...', end=' ')
+                for process, stderr_file in decrypt_processes:
+                    if process.wait():
+                        stderr_file.seek(0)
+                        stderr = stderr_file.read().decode(errors="replace").strip()
+                        raise DecryptionError(f'mp4decrypt failed: {stderr}')
+                print('Done')
+        finally:
+            # Children run in their own session and don't receive Ctrl-C, so stop them explicitly
+            for process, stderr_file in decrypt_processes:
+                if process.poll() is None:
+                    process.kill()
+                    process.wait()
+                stderr_file.close()
 
         filepath = Path(filepath).with_suffix('.mp4')
         filepath.parent.mkdir(parents=True, exist_ok=True)
@@ -14,6 +14,10 @@ class InvalidResolution(Exception):
     pass
 
 
+class InvalidManifest(Exception):
+    pass
+
+
 class DownloadError(Exception):
     pass
 
@@ -22,6 +26,14 @@ class SegmentDownloadError(DownloadError):
     pass
 
 
+class DecryptionError(DownloadError):
+    pass
+
+
+class MergeError(DownloadError):
+    pass
+
+
 class FFmpegNotFoundError(FileNotFoundError):
     pass
 